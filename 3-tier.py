@@ -15,6 +15,24 @@ Reference:
       C ⬅ ⬅ ⬅ V，
 视图将更新发送给控制器，控制更新数据管理模型，数据管理模型将更新返回给视图层。
 """
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import functools
+import io
+import itertools
+import json
+import queue
+import random
+import sqlite3
+import sys
+import threading
+import time
+import timeit
 
 
 class Data:
@@ -31,6 +49,155 @@ class Data:
         return {"products": self.products}
 
 
+class ColumnarProducts:
+    """列式存储
+        名字到行号的索引加上价格和数量两列紧凑数组，便于批量查询、求和与过滤。
+    """
+
+    def __init__(self, products):
+        self.names = list(products)
+        self.index = {name: row for row, name in enumerate(self.names)}
+        self.prices = array.array(
+            "d", (products[name]["price"] for name in self.names)
+        )
+        self.quantities = array.array(
+            "q", (products[name]["quantity"] for name in self.names)
+        )
+
+    def update(self, name, info):
+        """就地更新一行，新的商品追加到末尾"""
+        row = self.index.get(name)
+        if row is None:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+            self.prices.append(info["price"])
+            self.quantities.append(info["quantity"])
+        else:
+            self.prices[row] = info["price"]
+            self.quantities[row] = info["quantity"]
+
+    def rows(self, names):
+        index = self.index
+        return [index.get(name) for name in names]
+
+    def information_many(self, names):
+        prices, quantities = self.prices, self.quantities
+        return [
+            None
+            if row is None
+            else {"price": prices[row], "quantity": quantities[row]}
+            for row in self.rows(names)
+        ]
+
+    def total_value(self, names=None):
+        """库存总价值，不指定 names 则计算全部商品"""
+        prices, quantities = self.prices, self.quantities
+        if names is None:
+            return sum(map(lambda p, q: p * q, prices, quantities))
+        return sum(
+            prices[row] * quantities[row]
+            for row in self.rows(names)
+            if row is not None
+        )
+
+    def filter(self, max_price=None, min_quantity=None):
+        """返回价格不高于 max_price 且数量不少于 min_quantity 的商品名"""
+        return [
+            name
+            for name, price, quantity in zip(
+                self.names, self.prices, self.quantities
+            )
+            if (max_price is None or price <= max_price)
+            and (min_quantity is None or quantity >= min_quantity)
+        ]
+
+
+class SortedIndex:
+    """二级索引
+        按某个字段排好序的 (值, 商品名) 列表，区间查询和 top-k 查询都是 O(log n + k)。
+    """
+
+    def __init__(self, field, products):
+        self.field = field
+        self._entries = sorted(
+            (info[field], name) for name, info in products.items()
+        )
+
+    def add(self, name, value):
+        bisect.insort(self._entries, (value, name))
+
+    def discard(self, name, value):
+        i = bisect.bisect_left(self._entries, (value, name))
+        if i < len(self._entries) and self._entries[i] == (value, name):
+            del self._entries[i]
+
+    def between(self, low=None, high=None):
+        """返回 low <= 值 < high 的商品名，按值升序"""
+        entries = self._entries
+        start = 0 if low is None else bisect.bisect_left(entries, (low,))
+        end = (
+            len(entries)
+            if high is None
+            else bisect.bisect_left(entries, (high,))
+        )
+        return [name for _, name in entries[start:end]]
+
+    def top(self, k):
+        """返回值最大的 k 个商品名，按值降序"""
+        return [name for _, name in reversed(self._entries[-k:])] if k else []
+
+
+class ProductCache:
+    """读穿透缓存
+        位于业务逻辑和数据存储之间，按 LRU 和 TTL 淘汰缓存项，并统计命中和未命中的次数。
+    """
+
+    _missing = object()
+
+    def __init__(self, maxsize=128, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        """命中缓存则直接返回，否则调用 loader 从数据存储中读取并缓存起来"""
+        value, expires = self._items.get(key, (self._missing, None))
+        if value is not self._missing and (
+            expires is None or expires > self._clock()
+        ):
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = loader()
+        self._items[key] = (
+            value,
+            None if self.ttl is None else self._clock() + self.ttl,
+        )
+        self._items.move_to_end(key)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+        return value
+
+    def invalidate(self, key=None):
+        """写入数据之后让缓存失效，不指定 key 则清空所有缓存"""
+        if key is None:
+            self._items.clear()
+        else:
+            self._items.pop(key, None)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._items),
+        }
+
+
 class BusinessLogic:
     """应用处理
         业务逻辑有所有的数据存储实例
@@ -38,11 +205,90 @@ class BusinessLogic:
 
     data = Data()
 
+    def __init__(self, cache=None):
+        # 可选的缓存层，为 None 时每次都访问数据存储
+        self.cache = cache
+        self._columns = None
+        self._indexes = {}
+
+    def _read(self, key, loader):
+        if self.cache is None:
+            return loader()
+        return self.cache.get(key, loader)
+
     def product_list(self):
-        return self.data["products"].keys()
+        # 缓存不可变的元组，调用者无法修改缓存中的结果
+        return self._read(
+            ("product_list",), lambda: tuple(self.data["products"].keys())
+        )
 
     def product_information(self, product):
-        return self.data["products"].get(product, None)
+        return self._read(
+            ("product_information", product),
+            lambda: self.data["products"].get(product, None),
+        )
+
+    def product_information_many(self, products):
+        """批量查询，一次访问数据存储，不存在的商品返回 None"""
+        return self.columns().information_many(products)
+
+    def columns(self):
+        """数据存储的列式视图，第一次使用时建立，之后随写入就地更新"""
+        if self._columns is None:
+            self._columns = ColumnarProducts(self.data["products"])
+        return self._columns
+
+    def index(self, field):
+        """字段的二级索引，第一次使用时建立，之后随写入增量维护"""
+        if field not in self._indexes:
+            self._indexes[field] = SortedIndex(field, self.data["products"])
+        return self._indexes[field]
+
+    def products_between(self, field, low=None, high=None):
+        return self.index(field).between(low, high)
+
+    def top_products(self, field, k):
+        return self.index(field).top(k)
+
+    def ingest(self, path, **kwargs):
+        """批量导入数据存储，完成之后让缓存、列式视图和索引全部失效"""
+        try:
+            return ingest_products(path, self.data["products"], **kwargs)
+        finally:
+            self.invalidate()
+
+    def invalidate(self):
+        self._columns = None
+        self._indexes = {}
+        if self.cache is not None:
+            self.cache.invalidate()
+
+    def update_product(self, product, **info):
+        """写入数据存储，并让相关的缓存和索引失效
+
+        新的商品必须同时提供价格和数量。
+        """
+        products = self.data["products"]
+        if product not in products:
+            missing = {"price", "quantity"} - set(info)
+            if missing:
+                raise ValueError(
+                    "new product {0} is missing {1}".format(
+                        product, ", ".join(sorted(missing))
+                    )
+                )
+        current = products.setdefault(product, {})
+        for field, index in self._indexes.items():
+            if field in current:
+                index.discard(product, current[field])
+            if field in info or field in current:
+                index.add(product, info.get(field, current.get(field)))
+        current.update(info)
+        if self._columns is not None:
+            self._columns.update(product, current)
+        if self.cache is not None:
+            self.cache.invalidate(("product_list",))
+            self.cache.invalidate(("product_information", product))
 
 
 class Ui:
@@ -72,7 +318,328 @@ class Ui:
             )
 
 
+# 批量导入：按块读取 CSV 或 JSON-lines 文件，内存占用与文件大小无关，
+# 可以选择在进程池中并行解析。
+
+
+def _parse_csv_records(fieldnames, records):
+    # records 是未解析的 CSV 记录文本，按表头映射列
+    return [
+        (
+            record["name"],
+            {
+                "price": float(record["price"]),
+                "quantity": int(record["quantity"]),
+            },
+        )
+        for record in csv.DictReader(records, fieldnames=fieldnames)
+    ]
+
+
+def _parse_jsonl_lines(lines):
+    rows = []
+    for line in lines:
+        if line.strip():
+            row = json.loads(line)
+            info = {
+                "price": float(row["price"]),
+                "quantity": int(row["quantity"]),
+            }
+            rows.append((row["name"], info))
+    return rows
+
+
+def _is_jsonl(path):
+    return path.endswith((".jsonl", ".ndjson"))
+
+
+def read_records(path):
+    """逐条产出文件中未解析的记录文本
+
+    JSON-lines 文件每一行是一条记录；CSV 文件中引号内的换行属于同一条记录，
+    所以按引号个数的奇偶判断记录的边界，分块时不会把一条记录拆开。
+    """
+    with open(path, newline="") as f:
+        if _is_jsonl(path):
+            yield from f
+            return
+        lines, quotes = [], 0
+        for line in f:
+            lines.append(line)
+            quotes += line.count('"')
+            if quotes % 2 == 0:
+                yield "".join(lines)
+                lines, quotes = [], 0
+        if lines:
+            yield "".join(lines)
+
+
+def ingest_products(path, products, chunk_size=10000, workers=None):
+    """将文件中的商品导入 products 字典，返回行数、耗时和每秒行数
+
+    支持 CSV 和 JSON-lines（.jsonl 或 .ndjson）文件。workers 为 None 时在当前进程中
+    解析，否则使用指定大小的进程池，同时最多有 2 * workers 个块在解析中。
+    导入业务逻辑使用的数据存储时使用 `BusinessLogic.ingest()`，它会让缓存和索引失效。
+    """
+    if path.endswith(".json"):
+        raise ValueError("JSON arrays are not supported, use JSON-lines")
+    records = read_records(path)
+    if _is_jsonl(path):
+        parse = _parse_jsonl_lines
+    else:
+        fieldnames = next(csv.reader([next(records, "")]), None)
+        parse = functools.partial(_parse_csv_records, fieldnames)
+    # 工作进程收到的是未解析的文本块，解析本身在进程池中完成
+    chunks = iter(lambda: list(itertools.islice(records, chunk_size)), [])
+    count = 0
+    started = time.perf_counter()
+
+    def store(rows):
+        products.update(rows)
+        return len(rows)
+
+    if workers is None:
+        for chunk in chunks:
+            count += store(parse(chunk))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(executor.submit(parse, chunk))
+                if len(pending) >= 2 * workers:
+                    count += store(pending.popleft().result())
+            while pending:
+                count += store(pending.popleft().result())
+
+    seconds = time.perf_counter() - started
+    return {
+        "rows": count,
+        "seconds": seconds,
+        "rows_per_sec": count / seconds if seconds else float("inf"),
+    }
+
+
+# 异步版本的三层结构：数据层使用 SQLite 和一个有界连接池，查询在线程中执行，
+# 所以并发的 UI 请求可以重叠它们的存储 I/O。
+
+
+class AsyncData:
+    """异步数据存储类"""
+
+    _select_one = "SELECT price, quantity FROM products WHERE name = ?"
+    _select_names = "SELECT name FROM products ORDER BY rowid"
+
+    def __init__(
+        self, database="file:products?mode=memory&cache=shared", pool_size=4
+    ):
+        self.database = database
+        self.pool_size = pool_size
+        # 信号量限制同时使用的连接数，连接按需创建并全部记录下来以便关闭
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._idle = queue.LifoQueue()
+        self._connections = []
+        self._lock = threading.Lock()
+        # 共享内存数据库在最后一个连接关闭时被销毁，所以保留一个连接
+        self._keeper = self._connect()
+        with self._keeper:
+            self._keeper.execute(
+                "CREATE TABLE IF NOT EXISTS products "
+                "(name TEXT PRIMARY KEY, price REAL, quantity INTEGER)"
+            )
+            self._keeper.executemany(
+                "INSERT OR IGNORE INTO products VALUES (?, ?, ?)",
+                [
+                    (name, info["price"], info["quantity"])
+                    for name, info in Data.products.items()
+                ],
+            )
+
+    def _connect(self):
+        return sqlite3.connect(
+            self.database, uri=True, check_same_thread=False
+        )
+
+    def _execute(self, sql, params):
+        # 在工作线程中执行；连接池是线程安全的，不绑定任何事件循环
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self._connect()
+                with self._lock:
+                    self._connections.append(connection)
+            try:
+                return connection.execute(sql, params).fetchall()
+            finally:
+                self._idle.put(connection)
+
+    async def _query(self, sql, params=()):
+        # 语句使用固定的 SQL 文本，sqlite3 会缓存编译后的预处理语句
+        return await asyncio.to_thread(self._execute, sql, params)
+
+    async def product_names(self):
+        return [name for name, in await self._query(self._select_names)]
+
+    async def product(self, name):
+        rows = await self._query(self._select_one, (name,))
+        if not rows:
+            return None
+        price, quantity = rows[0]
+        return {"price": price, "quantity": quantity}
+
+    async def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._idle = queue.LifoQueue()
+        self._keeper.close()
+
+
+class AsyncBusinessLogic:
+    """异步应用处理"""
+
+    def __init__(self, data=None):
+        self.data = data or AsyncData()
+
+    async def product_list(self):
+        return await self.data.product_names()
+
+    async def product_information(self, product):
+        return await self.data.product(product)
+
+
+class AsyncUi:
+    """异步 UI 交互类"""
+
+    def __init__(self, business_logic=None):
+        self.business_logic = business_logic or AsyncBusinessLogic()
+
+    async def get_product_list(self):
+        print("PRODUCT LIST:")
+        for product in await self.business_logic.product_list():
+            print(product)
+        print("")
+
+    async def get_product_information(self, product):
+        product_info = await self.business_logic.product_information(product)
+        if product_info:
+            print("PRODUCT INFORMATION:")
+            print(
+                "Name: {0}, Price: {1:.2f}, Quantity: {2:}".format(
+                    product.title(),
+                    product_info.get("price", 0),
+                    product_info.get("quantity", 0),
+                )
+            )
+
+
 def main():
+    """
+    >>> business_logic = BusinessLogic(cache=ProductCache(maxsize=16, ttl=60))
+    >>> business_logic.product_information("milk")
+    (Fetching from Data Store)
+    {'price': 1.5, 'quantity': 10}
+    >>> business_logic.product_information("milk")
+    {'price': 1.5, 'quantity': 10}
+    >>> business_logic.update_product("milk", quantity=9)
+    (Fetching from Data Store)
+    >>> business_logic.product_information("milk")
+    (Fetching from Data Store)
+    {'price': 1.5, 'quantity': 9}
+    >>> business_logic.update_product("milk", quantity=10)
+    (Fetching from Data Store)
+    >>> business_logic.cache.stats()
+    {'hits': 1, 'misses': 2, 'size': 0}
+
+    >>> business_logic.product_information_many(["eggs", "arepass", "cheese"])
+    (Fetching from Data Store)
+    [{'price': 0.2, 'quantity': 100}, None, {'price': 2.0, 'quantity': 10}]
+    >>> round(business_logic.columns().total_value(), 2)
+    55.0
+    >>> business_logic.columns().filter(max_price=1.00, min_quantity=50)
+    ['eggs']
+    >>> business_logic.update_product("eggs", quantity=40)
+    (Fetching from Data Store)
+    >>> business_logic.product_information_many(["eggs"])
+    [{'price': 0.2, 'quantity': 40}]
+    >>> business_logic.update_product("eggs", quantity=100)
+    (Fetching from Data Store)
+
+    >>> cheap = business_logic.products_between("price", high=1.00)
+    (Fetching from Data Store)
+    >>> plenty = business_logic.products_between("quantity", low=51)
+    (Fetching from Data Store)
+    >>> sorted(set(cheap) & set(plenty))
+    ['eggs']
+    >>> business_logic.update_product("cheese", price=0.90)
+    (Fetching from Data Store)
+    >>> business_logic.products_between("price", high=1.00)
+    ['eggs', 'cheese']
+    >>> business_logic.top_products("quantity", 1)
+    ['eggs']
+    >>> business_logic.update_product("cheese", price=2.00)
+    (Fetching from Data Store)
+    >>> business_logic.update_product("bread", price=1.00)
+    Traceback (most recent call last):
+    ...
+    ValueError: new product bread is missing quantity
+
+    >>> import os, tempfile
+    >>> f = tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False)
+    >>> _ = f.write("name,price,quantity\\nbread,1.20,30\\nbutter,2.50,12\\n")
+    >>> f.close()
+    >>> products = {}
+    >>> ingest_products(f.name, products, chunk_size=1)["rows"]
+    2
+    >>> products["butter"]
+    {'price': 2.5, 'quantity': 12}
+    >>> os.unlink(f.name)
+
+    >>> f = tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False)
+    >>> _ = f.write('quantity,name,price\\n7,"jam\\nstrawberry",3.10\\n')
+    >>> f.close()
+    >>> business_logic.product_list()
+    (Fetching from Data Store)
+    ('milk', 'eggs', 'cheese')
+    >>> business_logic.ingest(f.name)["rows"]
+    (Fetching from Data Store)
+    1
+    >>> business_logic.product_list()
+    (Fetching from Data Store)
+    ('milk', 'eggs', 'cheese', 'jam\\nstrawberry')
+    >>> Data.products.pop("jam\\nstrawberry")
+    {'price': 3.1, 'quantity': 7}
+    >>> business_logic.invalidate()
+    >>> os.unlink(f.name)
+
+    >>> ui = AsyncUi()
+    >>> async def async_main():
+    ...     await ui.get_product_list()
+    ...     await asyncio.gather(
+    ...         ui.get_product_information("cheese"),
+    ...         ui.get_product_information("arepass"),
+    ...     )
+    >>> asyncio.run(async_main())
+    PRODUCT LIST:
+    milk
+    eggs
+    cheese
+    <BLANKLINE>
+    PRODUCT INFORMATION:
+    Name: Cheese, Price: 2.00, Quantity: 10
+
+    # 同一个数据层可以在另一个事件循环中继续使用
+    >>> asyncio.run(async_main())
+    PRODUCT LIST:
+    milk
+    eggs
+    cheese
+    <BLANKLINE>
+    PRODUCT INFORMATION:
+    Name: Cheese, Price: 2.00, Quantity: 10
+    >>> asyncio.run(ui.business_logic.data.close())
+    """
     ui = Ui()
     ui.get_product_list()
     ui.get_product_information("cheese")
@@ -81,8 +648,74 @@ def main():
     ui.get_product_information("arepass")
 
 
+def benchmark_async(requests=2000):
+    """比较同步路径和异步并发路径每秒处理的请求数"""
+    names = list(Data.products) + ["arepass"]
+    business_logic = BusinessLogic()
+    started = time.perf_counter()
+    # 同步路径每次访问都会打印数据存储的提示，测试时丢弃输出
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(requests):
+            business_logic.product_information(names[i % len(names)])
+    seconds = time.perf_counter() - started
+    print("sync: {0:.0f} requests/s".format(requests / seconds))
+
+    async_logic = AsyncBusinessLogic()
+
+    async def run():
+        await asyncio.gather(
+            *(
+                async_logic.product_information(names[i % len(names)])
+                for i in range(requests)
+            )
+        )
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    seconds = time.perf_counter() - started
+    print("async sqlite: {0:.0f} requests/s".format(requests / seconds))
+    asyncio.run(async_logic.data.close())
+
+
+def benchmark_indexes(n=1000000, queries=100):
+    """比较二级索引和线性扫描的区间查询"""
+    products = {
+        "product{0}".format(i): {
+            "price": random.uniform(0, 100),
+            "quantity": random.randrange(1000),
+        }
+        for i in range(n)
+    }
+    started = time.perf_counter()
+    index = SortedIndex("price", products)
+    print("index build: {0:.3f}s".format(time.perf_counter() - started))
+
+    def indexed():
+        low = random.uniform(0, 99)
+        return index.between(low, low + 0.01)
+
+    def scan():
+        low = random.uniform(0, 99)
+        return [
+            name
+            for name, info in products.items()
+            if low <= info["price"] < low + 0.01
+        ]
+
+    for label, query in (("index", indexed), ("scan", scan)):
+        seconds = timeit.timeit(query, number=queries) / queries
+        print("{0}: {1:.6f}s per range query".format(label, seconds))
+    seconds = timeit.timeit(lambda: index.top(10), number=queries) / queries
+    print("index: {0:.6f}s per top-10 query".format(seconds))
+
+
 if __name__ == "__main__":
-    main()
+    # python 3-tier.py --benchmark 运行性能测试
+    if "--benchmark" in sys.argv:
+        benchmark_async()
+        benchmark_indexes()
+    else:
+        main()
 
 
 #####Output#####
@@ -28,6 +28,7 @@ TL;DR
 """
 
 
+import collections
 import random
 
 
@@ -47,9 +48,72 @@ class PetShop:
             使用抽象工厂创建并显示一只宠物。
         """
 
-        pet = self.pet_factory()
+        self._show(self.pet_factory())
+
+    def show_pets(self, n):
+        """
+            一次创建并显示 n 只宠物，工厂支持 `create_many` 时使用批量创建。
+        """
+
+        create_many = getattr(self.pet_factory, "create_many", None)
+        if create_many is not None:
+            pets = create_many(n)
+        else:
+            pets = [self.pet_factory() for _ in range(n)]
+        for pet in pets:
+            self._show(pet)
+
+    def _show(self, pet):
         print(f"We have a lovely {pet}")
         print(f"It says {pet.speak()}")
+        # 对象池工厂需要将宠物归还回去
+        release = getattr(self.pet_factory, "release", None)
+        if release is not None:
+            release(pet)
+
+
+class PooledFactory:
+    """对象池工厂
+
+    包装任意一个工厂，预先创建 size 个实例，调用时从池中取出，用完通过 `release()` 归还，
+    归还时调用 reset 钩子清理状态。池中最多保留 max_size 个实例，多余的直接丢弃。
+    它本身也是一个可调用对象，所以可以直接传给 PetShop。
+    """
+
+    def __init__(self, factory, size=0, max_size=None, reset=None):
+        self.factory = factory
+        self.max_size = size if max_size is None else max_size
+        self.reset = reset
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self._free = [self._create() for _ in range(size)]
+
+    def _create(self):
+        self.created += 1
+        return self.factory()
+
+    def __call__(self):
+        if self._free:
+            self.reused += 1
+            return self._free.pop()
+        return self._create()
+
+    def release(self, obj):
+        if len(self._free) >= self.max_size:
+            self.discarded += 1
+            return
+        if self.reset is not None:
+            self.reset(obj)
+        self._free.append(obj)
+
+    def stats(self):
+        return {
+            "created": self.created,
+            "reused": self.reused,
+            "discarded": self.discarded,
+            "free": len(self._free),
+        }
 
 
 class Dog:
@@ -68,10 +132,33 @@ class Cat:
         return "Cat"
 
 
+class RandomFactory:
+    """随机地动态创建实例的工厂！"""
+
+    def __init__(self, classes, weights=None):
+        self.classes = tuple(classes)
+        self.weights = weights
+
+    def __call__(self):
+        return random.choices(self.classes, self.weights)[0]()
+
+    def create_many(self, n, weights=None):
+        """
+            一次抽取整批的类，再按具体类分组创建实例，返回的实例按类分组排列。
+        """
+
+        if weights is None:
+            weights = self.weights
+        counts = collections.Counter(
+            random.choices(self.classes, weights, k=n)
+        )
+        return [
+            klass() for klass, count in counts.items() for _ in range(count)
+        ]
+
+
 # 随意创建一直动物实例
-def random_animal():
-    """随机地动态创建动物实例！"""
-    return random.choice([Dog, Cat])()
+random_animal = RandomFactory((Dog, Cat))
 
 
 # 使用不同的工厂显示宠物
@@ -88,6 +175,17 @@ if __name__ == "__main__":
         shop.show_pet()
         print("=" * 20)
 
+    # 使用预先创建好狗的对象池的商店
+    dog_shop = PetShop(PooledFactory(Dog, size=2))
+    for _ in range(3):
+        dog_shop.show_pet()
+    print(dog_shop.pet_factory.stats())
+    print("")
+
+    # 一次批量创建，只卖狗
+    dog_factory = RandomFactory((Dog, Cat), weights=(1, 0))
+    PetShop(dog_factory).show_pets(2)
+
 
 # 输出
 # We have a lovely Cat
@@ -102,3 +200,15 @@ if __name__ == "__main__":
 # We have a lovely Cat
 # It says meow
 # ====================
+# We have a lovely Dog
+# It says woof
+# We have a lovely Dog
+# It says woof
+# We have a lovely Dog
+# It says woof
+# {'created': 2, 'reused': 3, 'discarded': 0, 'free': 2}
+
+# We have a lovely Dog
+# It says woof
+# We have a lovely Dog
+# It says woof
@@ -22,6 +22,12 @@ http://python-3-patterns-idioms-test.readthedocs.io/en/latest/ChangeInterface.ht
 
 总而言之，就是允许一个存在的类的接口当作另外接口来世使用。
 """
+import asyncio
+import functools
+import inspect
+import operator
+import threading
+import weakref
 
 
 class Dog:
@@ -78,6 +84,195 @@ class Adapter:
         return self.obj.__dict__
 
 
+# 每个被适配对象共享的信号量，由第一个适配它的 AsyncAdapter 决定并发上限
+_adaptee_semaphores = weakref.WeakKeyDictionary()
+# 不能弱引用的对象按 id 保存，对象需要在适配器之外保持存活
+_unweakrefable_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+
+def _adaptee_semaphore(obj, max_concurrency):
+    with _semaphores_lock:
+        try:
+            return _adaptee_semaphores.setdefault(
+                obj, threading.BoundedSemaphore(max_concurrency)
+            )
+        except TypeError:
+            return _unweakrefable_semaphores.setdefault(
+                id(obj), threading.BoundedSemaphore(max_concurrency)
+            )
+
+
+class AsyncAdapter:
+    """
+    将阻塞的适配方法暴露为协程的适配器。
+    阻塞方法在线程池中执行，本身已经是协程函数的方法原样传递；每个被适配的对象最多同时执行
+    max_concurrency 个调用。限制使用在工作线程中获取的线程信号量，不绑定事件循环，
+    同一个对象的所有适配器共享它，上限由第一个适配器决定。
+    使用：
+    car = Car()
+    car = AsyncAdapter(car, make_noise=car.make_noise)
+    await car.make_noise(3)
+    """
+
+    def __init__(
+        self, obj, executor=None, max_concurrency=1, **adapted_methods
+    ):
+        self.obj = obj
+        # executor 为 None 时使用事件循环默认的有界线程池
+        self._executor = executor
+        self._semaphore = _adaptee_semaphore(obj, max_concurrency)
+        for name, method in adapted_methods.items():
+            self.__dict__[name] = self._wrap(method)
+
+    def _wrap(self, method):
+        if inspect.iscoroutinefunction(method):
+            return method
+
+        semaphore = self._semaphore
+
+        def limited(*args, **kwargs):
+            with semaphore:
+                return method(*args, **kwargs)
+
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(limited, *args, **kwargs)
+            )
+
+        return wrapper
+
+    def __getattr__(self, attr):
+        """所有未适配的调用都传递给对象"""
+        return getattr(self.obj, attr)
+
+    def original_dict(self):
+        """打印原来对象的字典"""
+        return self.obj.__dict__
+
+
+def _passthrough(name):
+    """生成直接读写被适配对象属性的描述器"""
+
+    def setter(self, value):
+        setattr(self.obj, name, value)
+
+    return property(operator.attrgetter("obj." + name), setter)
+
+
+# 每个类型第一次被适配时记录的实例属性名
+_instance_attributes = {}
+
+
+@functools.lru_cache(maxsize=None)
+def _adapter_class(adaptee_type, adapted, attributes):
+    # 适配的方法各占一个 slot，初始化时保存绑定好的方法，调用时不需要再创建绑定方法
+    attrs = {"__slots__": adapted}
+    for name in set(dir(adaptee_type)) | set(attributes):
+        if (
+            not name.startswith("_")
+            and name not in adapted
+            and not hasattr(CompiledAdapter, name)
+        ):
+            attrs[name] = _passthrough(name)
+    return type(
+        "{0}Adapter".format(adaptee_type.__name__), (CompiledAdapter,), attrs
+    )
+
+
+class CompiledAdapter:
+    """
+    编译好的适配器的基类。
+    每种 (被适配的类型, 适配的方法名) 只生成一次适配器类，类使用 `__slots__`。
+    适配的方法在初始化时绑定并保存在 slot 中；被适配类型上的公开属性，以及第一次适配
+    这个类型时对象上已有的属性，都是直接转发的描述器，不再经过实例字典和 `__getattr__`。
+    其他属性仍然通过 `__getattr__` 读取，赋值时写入被适配的对象。
+    """
+
+    __slots__ = ("obj",)
+
+    def __init__(self, obj, methods):
+        object.__setattr__(self, "obj", obj)
+        for name, method in methods.items():
+            object.__setattr__(self, name, method)
+
+    def __getattr__(self, attr):
+        """生成类时不知道的属性仍然传递给对象"""
+        return getattr(self.obj, attr)
+
+    def __setattr__(self, attr, value):
+        if attr == "obj" or attr in type(self).__slots__:
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self.obj, attr, value)
+
+    def original_dict(self):
+        """打印原来对象的字典"""
+        return self.obj.__dict__
+
+
+def adapt(obj, **adapted_methods):
+    """
+    使用编译好的适配器类适配一个对象。
+    方法映射的值可以是被适配对象的方法名，或者以被适配对象为第一个参数的可调用对象。
+    适配器类只由对象的类型和适配的方法名决定，所以同一个类型的对象共享同一个适配器类。
+    使用：
+    dog = adapt(Dog(), make_noise="bark")
+    """
+    adaptee_type = type(obj)
+    attributes = _instance_attributes.setdefault(
+        adaptee_type, tuple(sorted(getattr(obj, "__dict__", ())))
+    )
+    methods = {
+        name: getattr(obj, target)
+        if isinstance(target, str)
+        else functools.partial(target, obj)
+        for name, target in adapted_methods.items()
+    }
+    klass = _adapter_class(
+        adaptee_type, tuple(sorted(adapted_methods)), attributes
+    )
+    return klass(obj, methods)
+
+
+def benchmark(number=300000, instances=10000):
+    """比较 Adapter 和编译好的适配器的每次调用耗时和每个实例的内存"""
+    import timeit
+    import tracemalloc
+
+    dog = Dog()
+    adapters = {
+        "Adapter": Adapter(dog, make_noise=dog.bark),
+        "adapt": adapt(dog, make_noise="bark"),
+    }
+    for label, adapter in adapters.items():
+        call = timeit.timeit(lambda: adapter.make_noise(), number=number)
+        name = timeit.timeit(lambda: adapter.name, number=number)
+        print(
+            "{0}: make_noise() {1:.3f}s, .name {2:.3f}s per {3} calls".format(
+                label, call, name, number
+            )
+        )
+
+    objects = [cls() for cls in (Dog, Cat, Human) for _ in range(instances)]
+    methods = {Dog: "bark", Cat: "meow", Human: "speak"}
+    factories = {
+        "Adapter": lambda o: Adapter(
+            o, make_noise=getattr(o, methods[type(o)])
+        ),
+        "adapt": lambda o: adapt(o, make_noise=methods[type(o)]),
+    }
+    for label, factory in factories.items():
+        tracemalloc.start()
+        adapted = [factory(o) for o in objects]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        per_instance = size / len(adapted)
+        print("{0}: {1:.0f} bytes per instance".format(label, per_instance))
+
+
 def main():
     """
     >>> objects = []
@@ -106,10 +301,56 @@ def main():
     A Cat goes meow!
     A Human goes 'hello'
     A Car goes vroom!!!
+
+    >>> compiled = [
+    ...     adapt(Dog(), make_noise="bark"),
+    ...     adapt(Cat(), make_noise="meow"),
+    ...     adapt(Human(), make_noise="speak"),
+    ...     adapt(Car(), make_noise=lambda car: car.make_noise(3)),
+    ... ]
+    >>> for obj in compiled:
+    ...    print("A {0} goes {1}".format(obj.name, obj.make_noise()))
+    A Dog goes woof!
+    A Cat goes meow!
+    A Human goes 'hello'
+    A Car goes vroom!!!
+
+    >>> type(adapt(Dog(), make_noise="bark")) is type(compiled[0])
+    True
+    >>> car = adapt(Car(), make_noise=lambda car: car.make_noise(1))
+    >>> type(car) is type(compiled[3])
+    True
+    >>> car.name = "Truck"
+    >>> car.name, car.obj.name, car.make_noise()
+    ('Truck', 'Truck', 'vroom!')
+
+    >>> async def noises():
+    ...     car = Car()
+    ...     car = AsyncAdapter(
+    ...         car, max_concurrency=2, make_noise=car.make_noise
+    ...     )
+    ...     return await asyncio.gather(*(car.make_noise(i) for i in range(3)))
+    >>> asyncio.run(noises())
+    ['vroom', 'vroom!', 'vroom!!']
+
+    同一个对象的适配器共享并发上限，也可以在不同的事件循环中使用：
+    >>> car = Car()
+    >>> first = AsyncAdapter(car, max_concurrency=2, make_noise=car.make_noise)
+    >>> second = AsyncAdapter(car, make_noise=car.make_noise)
+    >>> first._semaphore is second._semaphore
+    True
+    >>> asyncio.run(second.make_noise(1)), asyncio.run(first.make_noise(2))
+    ('vroom!', 'vroom!!')
     """
 
 
 if __name__ == "__main__":
-    import doctest
+    import sys
+
+    # python adapter.py --benchmark 运行性能测试
+    if "--benchmark" in sys.argv:
+        benchmark()
+    else:
+        import doctest
 
-    doctest.testmod(verbose=True)
+        doctest.testmod(verbose=True)
@@ -7,20 +7,161 @@ http://en.wikibooks.org/wiki/Computer_Science_Design_Patterns/Bridge_Pattern#Pyt
 
 """
 #!/usr/bin/python3
+import array
+import concurrent.futures
+import math
+from multiprocessing import shared_memory
+
+
+# 实现器接口，默认的批量绘制逐个调用 draw_circle，具体实现器可以覆盖它来一次处理整批
+class DrawingAPI:
+    def draw_circle(self, x, y, radius):
+        raise NotImplementedError
+
+    def draw_circles(self, xs, ys, radii):
+        for x, y, radius in zip(xs, ys, radii):
+            self.draw_circle(x, y, radius)
 
 
 # 具体实现器 1/2
-class DrawingAPI1:
+class DrawingAPI1(DrawingAPI):
     def draw_circle(self, x, y, radius):
         print("API1.circle at {}:{} radius {}".format(x, y, radius))
 
 
 # 具体实现器 2/2
-class DrawingAPI2:
+class DrawingAPI2(DrawingAPI):
     def draw_circle(self, x, y, radius):
         print("API2.circle at {}:{} radius {}".format(x, y, radius))
 
 
+def _render_tile(buffer, width, color, antialias, tile, circles):
+    x0, y0, x1, y1 = tile
+    for cx, cy, radius in circles:
+        # 将圆的外接矩形裁剪到当前块内
+        left = max(x0, math.floor(cx - radius - 1))
+        right = min(x1, math.ceil(cx + radius + 1))
+        top = max(y0, math.floor(cy - radius - 1))
+        bottom = min(y1, math.ceil(cy + radius + 1))
+        for py in range(top, bottom):
+            dy = py + 0.5 - cy
+            for px in range(left, right):
+                distance = math.hypot(px + 0.5 - cx, dy)
+                if antialias:
+                    coverage = min(1.0, max(0.0, radius + 0.5 - distance))
+                else:
+                    coverage = 1.0 if distance <= radius else 0.0
+                if coverage:
+                    offset = (py * width + px) * 3
+                    for i in range(3):
+                        old = buffer[offset + i]
+                        buffer[offset + i] = round(
+                            old + (color[i] - old) * coverage
+                        )
+
+
+def _render_shared_tile(name, *args):
+    # 在工作进程中打开共享内存，直接写入帧缓冲区
+    memory = shared_memory.SharedMemory(name)
+    try:
+        _render_tile(memory.buf, *args)
+    finally:
+        memory.close()
+
+
+# 具体实现器 3，将圆光栅化到内存中的 RGB 帧缓冲区
+class RasterDrawingAPI(DrawingAPI):
+    def __init__(
+        self,
+        width,
+        height,
+        color=(255, 255, 255),
+        antialias=False,
+        tile_size=64,
+        workers=None,
+    ):
+        self.width = width
+        self.height = height
+        self.color = color
+        self.antialias = antialias
+        self.tile_size = tile_size
+        # workers 为 None 时在当前进程中逐块渲染，否则帧缓冲区放在共享内存中，
+        # 各块在进程池中并行渲染，可以使用所有的核心
+        self.workers = workers
+        size = width * height * 3
+        if workers is None:
+            self._memory = self._executor = None
+            self.buffer = bytearray(size)
+        else:
+            self._memory = shared_memory.SharedMemory(create=True, size=size)
+            self._executor = concurrent.futures.ProcessPoolExecutor(workers)
+            self.buffer = self._memory.buf[:size]
+
+    def draw_circle(self, x, y, radius):
+        self.draw_circles((x,), (y,), (radius,))
+
+    def draw_circles(self, xs, ys, radii):
+        size, width, height = self.tile_size, self.width, self.height
+        # 只把圆分配给它的外接矩形覆盖到的块，没有圆的块直接跳过
+        tiles = {}
+        for circle in zip(xs, ys, radii):
+            cx, cy, radius = circle
+            left = max(0, math.floor(cx - radius - 1)) // size
+            right = min(width - 1, math.ceil(cx + radius + 1)) // size
+            top = max(0, math.floor(cy - radius - 1)) // size
+            bottom = min(height - 1, math.ceil(cy + radius + 1)) // size
+            for row in range(top, bottom + 1):
+                for column in range(left, right + 1):
+                    tiles.setdefault((column, row), []).append(circle)
+
+        args = (width, self.color, self.antialias)
+        jobs = [
+            (
+                (
+                    column * size,
+                    row * size,
+                    min((column + 1) * size, width),
+                    min((row + 1) * size, height),
+                ),
+                circles,
+            )
+            for (column, row), circles in tiles.items()
+        ]
+        if self._executor is None:
+            for tile, circles in jobs:
+                _render_tile(self.buffer, *args, tile, circles)
+        else:
+            # 各块互不重叠，所以可以并发地写入同一个缓冲区
+            name = self._memory.name
+            futures = [
+                self._executor.submit(
+                    _render_shared_tile, name, *args, tile, circles
+                )
+                for tile, circles in jobs
+            ]
+            for future in futures:
+                future.result()
+
+    def close(self):
+        """释放进程池和共享内存"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self.buffer.release()
+            self._memory.close()
+            self._memory.unlink()
+            self._executor = self._memory = None
+
+    def write_raw(self, path):
+        with open(path, "wb") as f:
+            f.write(memoryview(self.buffer))
+
+    def write_ppm(self, path):
+        with open(path, "wb") as f:
+            f.write(b"P6\n%d %d\n255\n" % (self.width, self.height))
+            # memoryview 避免复制整个帧缓冲区
+            f.write(memoryview(self.buffer))
+
+
 # 提炼抽象概念
 class CircleShape:
     def __init__(self, x, y, radius, drawing_api):
@@ -38,6 +179,31 @@ class CircleShape:
         self._radius *= pct
 
 
+# 批量的抽象概念，将圆按列存放在 x, y 和半径三个数组中
+class CircleCollection:
+    def __init__(self, xs, ys, radii, drawing_api):
+        self._xs = array.array("d", xs)
+        self._ys = array.array("d", ys)
+        self._radii = array.array("d", radii)
+        self._drawing_api = drawing_api
+
+    def __len__(self):
+        return len(self._radii)
+
+    def add(self, x, y, radius):
+        self._xs.append(x)
+        self._ys.append(y)
+        self._radii.append(radius)
+
+    # 实现细节，整批交给实现器
+    def draw(self):
+        self._drawing_api.draw_circles(self._xs, self._ys, self._radii)
+
+    # 抽象细节，一次缩放整个半径数组
+    def scale(self, pct):
+        self._radii = array.array("d", [r * pct for r in self._radii])
+
+
 def main():
     shapes = (
         CircleShape(1, 2, 3, DrawingAPI1()),
@@ -48,6 +214,15 @@ def main():
         shape.scale(2.5)
         shape.draw()
 
+    circles = CircleCollection((1, 5), (2, 7), (3, 11), DrawingAPI1())
+    circles.scale(2.5)
+    circles.draw()
+
+    raster = RasterDrawingAPI(16, 16, tile_size=8, workers=4)
+    CircleShape(8, 8, 3, raster).draw()
+    print("Raster lit pixels {}".format(sum(map(bool, raster.buffer[::3]))))
+    raster.close()
+
 
 if __name__ == "__main__":
     main()
@@ -55,4 +230,7 @@ if __name__ == "__main__":
 ########## OUTPUT ##########
 # API1.circle at 1:2 radius 7.5
 # API2.circle at 5:7 radius 27.5
+# API1.circle at 1.0:2.0 radius 7.5
+# API1.circle at 5.0:7.0 radius 27.5
+# Raster lit pixels 32
 
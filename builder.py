@@ -24,6 +24,11 @@ https://sourcemaking.com/design_patterns/builder
 
 原文太长了，总而言之，将一个复杂对象的创建与其表现形式进行解偶。
 """
+import concurrent.futures
+import copy
+import sys
+import time
+import timeit
 
 # Abstract building
 class Building:
@@ -83,6 +88,235 @@ def construct_building(klass):
     return building
 
 
+# 当建立步骤开销大并且结果是确定的时候，可以缓存第一次建立的结果，之后从快照中复制对象，
+# 而不是重新执行每一个`build_*`步骤。
+
+
+def _slot_names(klass):
+    for base in klass.__mro__:
+        slots = base.__dict__.get("__slots__", ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        for name in slots:
+            if name not in ("__dict__", "__weakref__"):
+                yield name
+
+
+def _default_builder(klass, *args, **kwargs):
+    return klass(*args, **kwargs)
+
+
+_IMMUTABLE_TYPES = (str, bytes, int, float, complex, bool, type(None), range)
+
+
+def _is_immutable(value):
+    if isinstance(value, _IMMUTABLE_TYPES):
+        return True
+    if isinstance(value, (tuple, frozenset)):
+        return all(_is_immutable(item) for item in value)
+    return False
+
+
+def _is_flat(value):
+    """只包含不可变元素的列表、字典和集合，浅复制就足够了"""
+    if isinstance(value, (list, set, bytearray)):
+        return all(_is_immutable(item) for item in value)
+    if isinstance(value, dict):
+        return all(
+            _is_immutable(key) and _is_immutable(item)
+            for key, item in value.items()
+        )
+    return False
+
+
+class BuildCache:
+    """
+    缓存建立结果的快照。快照中不可变的值直接共享，只包含不可变元素的列表、字典和集合浅复制，
+    其他可变的值在每次建立时使用 copy_value 复制，默认是 copy.deepcopy；调用者也可以传入
+    copy.copy 之类更便宜的策略。
+    """
+
+    def __init__(self, builder=_default_builder, copy_value=copy.deepcopy):
+        self.builder = builder
+        self.copy_value = copy_value
+        self._snapshots = {}
+
+    def build(self, klass, *args, **kwargs):
+        if kwargs:
+            key = (klass, args, tuple(sorted(kwargs.items())))
+        else:
+            key = (klass, args)
+        snapshot = self._snapshots.get(key)
+        if snapshot is None:
+            building = self.builder(klass, *args, **kwargs)
+            self._snapshots[key] = self._snapshot(building)
+            return building
+        shared, shared_slots, mutable = snapshot
+        building = klass.__new__(klass)
+        if shared:
+            building.__dict__.update(shared)
+        for name, value in shared_slots:
+            object.__setattr__(building, name, value)
+        for name, value, flat in mutable:
+            value = value.copy() if flat else self.copy_value(value)
+            object.__setattr__(building, name, value)
+        return building
+
+    def invalidate(self, klass=None):
+        """清除缓存的快照，不指定 klass 则全部清除"""
+        if klass is None:
+            self._snapshots.clear()
+            return
+        for key in [key for key in self._snapshots if key[0] is klass]:
+            del self._snapshots[key]
+
+    @staticmethod
+    def _snapshot(building):
+        # 第一次建立的对象已经返回给调用者，快照要和它分开
+        state = copy.deepcopy(dict(getattr(building, "__dict__", {})))
+        slots = {
+            name: copy.deepcopy(getattr(building, name))
+            for name in _slot_names(type(building))
+            if hasattr(building, name)
+        }
+        shared = {
+            name: value
+            for name, value in state.items()
+            if _is_immutable(value)
+        }
+        shared_slots = tuple(
+            (name, value)
+            for name, value in slots.items()
+            if _is_immutable(value)
+        )
+        mutable = tuple(
+            (name, value, _is_flat(value))
+            for name, value in list(state.items()) + list(slots.items())
+            if not _is_immutable(value)
+        )
+        return shared, shared_slots, mutable
+
+
+def benchmark(number=20000):
+    """比较重新建立、复制整个快照和只复制可变值的耗时"""
+
+    class SurveyedHouse(ComplexHouse):
+        # 建立步骤需要一些计算，并且产生可变的状态
+        def build_size(self):
+            super().build_size()
+            self.rooms = sorted(str(i * i % 97) for i in range(200))
+
+    for klass in (ComplexHouse, SurveyedHouse):
+        state = dict(construct_building(klass).__dict__)
+
+        def deepcopy_snapshot():
+            building = klass.__new__(klass)
+            for name, value in copy.deepcopy(state).items():
+                object.__setattr__(building, name, value)
+            return building
+
+        cache = BuildCache(construct_building)
+        cases = (
+            ("construct_building", lambda: construct_building(klass)),
+            ("deepcopy snapshot", deepcopy_snapshot),
+            ("BuildCache", lambda: cache.build(klass)),
+        )
+        for label, build in cases:
+            elapsed = timeit.timeit(build, number=number)
+            print(
+                "{0} {1}: {2:.3f}s per {3} builds".format(
+                    klass.__name__, label, elapsed, number
+                )
+            )
+
+
+# 当一些建立步骤需要进行 I/O 并且互相独立时，可以声明步骤之间的依赖，让独立的步骤在线程池中
+# 并发执行，总耗时就变成关键路径的耗时，而不是所有步骤耗时之和。
+
+
+def depends_on(*names):
+    """声明一个建立步骤依赖的其他步骤"""
+
+    def decorator(step):
+        step.depends_on = names
+        return step
+
+    return decorator
+
+
+class ParallelBuilder:
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.timings = {}
+
+    @staticmethod
+    def steps(klass):
+        return {
+            name: getattr(getattr(klass, name), "depends_on", ())
+            for name in dir(klass)
+            if name.startswith("build_")
+        }
+
+    def construct(self, klass):
+        """并发执行 klass 的所有`build_*`步骤
+
+        使用`klass.__new__`分配对象而不调用`__init__`，所以像`House`这样在构造函数中
+        建立的类，每个步骤也只会执行一次。
+        """
+        building = klass.__new__(klass)
+        steps = self.steps(klass)
+        for name, deps in steps.items():
+            missing = set(deps) - set(steps)
+            if missing:
+                raise ValueError(f"{name} depends on unknown steps {missing}")
+
+        self.timings = {}
+        done = set()
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+            running = {}
+            while len(done) < len(steps):
+                for name, deps in steps.items():
+                    if (
+                        name not in done
+                        and name not in running.values()
+                        and done.issuperset(deps)
+                    ):
+                        future = executor.submit(self._run, building, name)
+                        running[future] = name
+                if not running:
+                    raise ValueError("circular dependency between build steps")
+                finished, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is not None:
+                        for pending in running:
+                            pending.cancel()
+                        raise future.exception()
+                    self.timings[name] = future.result()
+                    done.add(name)
+        return building
+
+    @staticmethod
+    def _run(building, name):
+        started = time.perf_counter()
+        getattr(building, name)()
+        return time.perf_counter() - started
+
+
+class TemplateHouse(ComplexBuilding):
+    def build_floor(self):
+        self.floor = "One"
+
+    def build_size(self):
+        self.size = "Big"
+
+    @depends_on("build_floor", "build_size")
+    def build_summary(self):
+        self.size = f"{self.size} with {self.floor} floor"
+
+
 # 客户端代码
 if __name__ == "__main__":
     house = House()
@@ -94,7 +328,24 @@ if __name__ == "__main__":
     complex_house = construct_building(ComplexHouse)
     print(complex_house)
 
+    # 使用缓存的建立结果
+    cache = BuildCache(construct_building)
+    houses = [cache.build(ComplexHouse) for _ in range(3)]
+    print(houses[2], houses[1] is houses[2])
+
+    # 并发执行独立的建立步骤
+    builder = ParallelBuilder()
+    print(builder.construct(TemplateHouse), sorted(builder.timings))
+    print(builder.construct(House))
+
+    # python builder.py --benchmark 比较建立耗时
+    if "--benchmark" in sys.argv:
+        benchmark()
+
 ######## OUTPUT ########
 # Floor: One | Size: Big
 # Floor: More than One | Size: Small
 # Floor: One | Size: Big and fancy
+# Floor: One | Size: Big and fancy False
+# Floor: One | Size: Big with One floor ['build_floor', 'build_size', 'build_summary']
+# Floor: One | Size: Big
@@ -1,6 +1,8 @@
 """
 通用方法将根据构造函数的的参数调用不同的特别的方法。
 """
+import timeit
+import types
 
 
 class Catalog:
@@ -137,6 +139,126 @@ class CatalogStatic:
         )()
 
 
+def catalog_method(param):
+    """将方法登记到目录中，param 是选择这个方法的参数值"""
+
+    def decorator(method):
+        method.catalog_param = param
+        return method
+
+    return decorator
+
+
+class CatalogDispatch:
+    """在类定义的时候建立一次不可变的分发表的目录。
+
+    子类使用`@catalog_method`登记方法，参数在初始化时只检查一次。
+    """
+
+    _dispatch_table = types.MappingProxyType({})
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        table = dict(cls._dispatch_table)
+        for attr in vars(cls).values():
+            param = getattr(attr, "catalog_param", None)
+            if param is not None:
+                table[param] = attr
+        cls._dispatch_table = types.MappingProxyType(table)
+
+    def __init__(self, param):
+        # 简单测试使得param值有效
+        if param not in self._dispatch_table:
+            raise ValueError("Invalid Value for Param: {0}".format(param))
+        self.param = param
+        self._target = self._dispatch_table[param]
+
+    def main_method(self):
+        """执行初始化时选定的方法"""
+        return self._target(self)
+
+    def dispatch_many(self, params):
+        """批量执行，按目标方法分组调用，结果按 params 的顺序返回"""
+        groups = {}
+        for i, param in enumerate(params):
+            try:
+                target = self._dispatch_table[param]
+            except KeyError:
+                raise ValueError("Invalid Value for Param: {0}".format(param))
+            groups.setdefault(target, []).append(i)
+
+        results = [None] * len(params)
+        for target, positions in groups.items():
+            for i in positions:
+                results[i] = target(self)
+        return results
+
+
+class CatalogRegistered(CatalogDispatch):
+    """使用登记的方法的目录"""
+
+    x1 = "x1"
+    x2 = "x2"
+
+    @catalog_method("param_value_1")
+    def _method_1(self):
+        print("Value {}".format(self.x1))
+
+    @catalog_method("param_value_2")
+    def _method_2(self):
+        print("Value {}".format(self.x2))
+
+
+def benchmark(number=1000000):
+    """比较每种目录执行 number 次分发的耗时
+
+    被分发的方法中的 print 被替换成什么都不做的函数，测量的是分发本身的开销。
+    Catalog 和 CatalogStatic 的方法不格式化字符串，和其他三种比较时要考虑这一点。
+    """
+    variants = (
+        Catalog,
+        CatalogInstance,
+        CatalogClass,
+        CatalogStatic,
+        CatalogRegistered,
+    )
+    timings = []
+    globals()["print"] = lambda *args, **kwargs: None
+    try:
+        for klass in variants:
+            catalog = klass("param_value_1")
+            timings.append(
+                (
+                    klass.__name__ + ".main_method",
+                    timeit.timeit(catalog.main_method, number=number),
+                )
+            )
+            # 每次分发都创建新的实例，包括初始化时建立分发表和检查参数的开销
+            timings.append(
+                (
+                    klass.__name__ + "(param).main_method",
+                    timeit.timeit(
+                        lambda: klass("param_value_1").main_method(),
+                        number=number,
+                    ),
+                )
+            )
+        params = ["param_value_1", "param_value_2"] * (number // 2)
+        catalog = CatalogRegistered("param_value_1")
+        timings.append(
+            (
+                "CatalogRegistered.dispatch_many",
+                timeit.timeit(lambda: catalog.dispatch_many(params), number=1),
+            )
+        )
+    finally:
+        del globals()["print"]
+    for label, elapsed in timings:
+        print(
+            "{0}: {1:.3f}s per {2} dispatches".format(label, elapsed, number)
+        )
+
+
 def main():
     """
     >>> test = Catalog('param_value_2')
@@ -154,11 +276,26 @@ def main():
     >>> test = CatalogStatic('param_value_1')
     >>> test.main_method()
     excuted method 1!
+
+    >>> test = CatalogRegistered('param_value_2')
+    >>> test.main_method()
+    Value x2
+    >>> params = ['param_value_1', 'param_value_2', 'param_value_1']
+    >>> _ = test.dispatch_many(params)
+    Value x1
+    Value x1
+    Value x2
     """
 
 
 if __name__ == "__main__":
-    import doctest
+    import sys
+
+    # python catalog.py --benchmark 运行性能测试
+    if "--benchmark" in sys.argv:
+        benchmark()
+    else:
+        import doctest
 
-    doctest.testmod(verbose=True)
+        doctest.testmod(verbose=True)
 
@@ -13,24 +13,75 @@
 总而言之，允许一个请求沿请求接收器链向下传递直到请求被处理。
 """
 import abc
+import asyncio
+import bisect
+import functools
+import inspect
+import random
+import sys
+import time
+import timeit
 
 
 class Handler(metaclass=abc.ABCMeta):
     """抽象类，不可以用于实例一个对象"""
 
+    # 处理程序可以声明它能处理的区间 (start, end)，默认是半开区间，
+    # interval_closed 为真时包含 end。没有声明区间的处理程序在编译好的链中按顺序遍历。
+    interval = None
+    interval_closed = False
+
+    # 任何处理程序的 successor 改变时增加版本号，缓存的展开链随之失效
+    _chain_version = 0
+
     def __init__(self, successor=None):
         self.successor = successor
 
+    @property
+    def successor(self):
+        return self._successor
+
+    @successor.setter
+    def successor(self, successor):
+        self._successor = successor
+        Handler._chain_version += 1
+
+    def _handlers(self):
+        """从这个处理程序开始展开的链，缓存到任何一个 successor 改变为止"""
+        cached = self.__dict__.get("_cached_chain")
+        if cached is not None and cached[0] == Handler._chain_version:
+            return cached[1]
+        handlers = []
+        seen = set()
+        handler = self
+        while handler:
+            if id(handler) in seen:
+                raise ValueError("handler chain contains a cycle")
+            seen.add(id(handler))
+            handlers.append(handler)
+            handler = handler.successor
+        handlers = tuple(handlers)
+        self._cached_chain = (Handler._chain_version, handlers)
+        return handlers
+
     def handle(self, request):
         """
         处理请求并停止。
         如果不能处理，调用链状中的下一个请求处理程序。
 
         可能调用下一个处理程序的时候，请求处理成功了作为第二种选择。
+        沿着展开的链循环处理，而不是递归调用，所以链的长度不受递归深度的限制。
+        """
+        for handler in self._handlers():
+            if handler.check_range(request):
+                return
+
+    def check_range_many(self, requests):
+        """批量处理一组请求，返回不能处理的请求
+
+        默认逐个调用 check_range，子类可以覆盖它来一次处理整批请求。
         """
-        res = self.check_range(request)
-        if not res and self.successor:
-            self.successor.handle(request)
+        return [r for r in requests if not self.check_range(r)]
 
     @abc.abstractmethod
     def check_range(self, request):
@@ -45,6 +96,9 @@ class ConcreteHandler0(Handler):
     保持简单和静态...
     """
 
+    interval = (0, 10)
+    interval_closed = True
+
     @staticmethod
     def check_range(request):
         if 0 <= request <= 10:
@@ -57,6 +111,10 @@ class ConcreteHandler1(Handler):
 
     start, end = 10, 20
 
+    @property
+    def interval(self):
+        return (self.start, self.end)
+
     def check_range(self, request):
         if self.start <= request < self.end:
             # 对象自己的内部状态
@@ -67,6 +125,10 @@ class ConcreteHandler1(Handler):
 class ConcreteHandler2(Handler):
     """使用助手方法。"""
 
+    @property
+    def interval(self):
+        return self.get_interval_from_db()
+
     def check_range(self, request):
         start, end = self.get_interval_from_db()  # 使用助手方法
         if start <= request < end:
@@ -86,6 +148,374 @@ class FallbackHandler(Handler):
         return False
 
 
+def async_ttl_cache(ttl, clock=time.monotonic):
+    """协程助手方法的 TTL 缓存
+
+    结果缓存 ttl 秒；同一个参数并发的查询共享同一个进行中的任务，只会真正查询一次。
+    查询失败的结果不会被缓存。
+    """
+
+    def decorator(function):
+        entries = {}
+
+        @functools.wraps(function)
+        async def wrapper(*args):
+            entry = entries.get(args)
+            if entry is None or entry[0] <= clock():
+                task = asyncio.ensure_future(function(*args))
+                entry = entries[args] = (clock() + ttl, task)
+            try:
+                return await asyncio.shield(entry[1])
+            except Exception:
+                if entries.get(args) is entry:
+                    del entries[args]
+                raise
+
+        wrapper.cache_clear = entries.clear
+        return wrapper
+
+    return decorator
+
+
+class AsyncHandler(Handler):
+    """异步处理程序，check_range 可以是协程
+
+    链上可以混合同步的处理程序，从这个处理程序开始沿着链向下处理请求。
+    """
+
+    async def handle(self, request):
+        for handler in self._handlers():
+            res = handler.check_range(request)
+            if inspect.isawaitable(res):
+                res = await res
+            if res:
+                return True
+        return False
+
+    async def prefetch(self):
+        """启动时预取处理程序需要的配置，子类可以覆盖"""
+
+    async def prefetch_chain(self):
+        """并发地预取整条链上所有异步处理程序的配置"""
+        await asyncio.gather(
+            *(
+                handler.prefetch()
+                for handler in self._handlers()
+                if isinstance(handler, AsyncHandler)
+            )
+        )
+
+
+class AsyncConcreteHandler2(AsyncHandler):
+    """使用缓存的异步助手方法。"""
+
+    async def check_range(self, request):
+        start, end = await self.get_interval_from_db()
+        if start <= request < end:
+            print("request {} handled in handler 2".format(request))
+            return True
+
+    @staticmethod
+    @async_ttl_cache(ttl=60)
+    async def get_interval_from_db():
+        """助手方法，模拟一次数据库查询"""
+        await asyncio.sleep(0)
+        return (20, 30)
+
+    async def prefetch(self):
+        await self.get_interval_from_db()
+
+
+class CompiledChain:
+    """编译好的处理程序链
+
+    将链上声明了区间的处理程序收集到一个有序的索引中，使用二分查找在 O(log n) 内找到
+    第一个能够处理请求的处理程序。没有声明区间的处理程序仍然按照链上的顺序遍历，
+    所以路由的结果与原来的链完全相同。链改变之后需要重新编译。
+    """
+
+    def __init__(self, head):
+        self.handlers = list(head._handlers())
+
+        self._intervals = [
+            (position, handler.interval, handler.interval_closed)
+            for position, handler in enumerate(self.handlers)
+            if handler.interval is not None
+        ]
+        # 区间端点把数轴分成端点本身和端点之间的开区间，每一段记录链上最靠前的处理程序
+        self._points = sorted(
+            {bound for _, interval, _ in self._intervals for bound in interval}
+        )
+        self._point_owners = [self._owner(p, p) for p in self._points]
+        bounds = [None] + self._points + [None]
+        self._gap_owners = [
+            None if lo is None or hi is None else self._owner(lo, hi)
+            for lo, hi in zip(bounds, bounds[1:])
+        ]
+        self._unindexed = [
+            position
+            for position, handler in enumerate(self.handlers)
+            if handler.interval is None
+        ]
+
+    def _owner(self, lo, hi):
+        """覆盖端点 lo 或开区间 (lo, hi) 的第一个处理程序的位置"""
+        for position, (start, end), closed in self._intervals:
+            if lo == hi:
+                if start <= lo < end or closed and lo == end:
+                    return position
+            elif start <= lo and hi <= end:
+                return position
+        return None
+
+    def owner(self, request):
+        """索引中能够处理请求的处理程序的位置，没有则返回 None"""
+        i = bisect.bisect_left(self._points, request)
+        if i < len(self._points) and self._points[i] == request:
+            return self._point_owners[i]
+        return self._gap_owners[i]
+
+    def route(self, request):
+        """返回按链上顺序需要依次尝试的处理程序的位置"""
+        owner = self.owner(request)
+        if owner is None:
+            return self._unindexed
+        return [p for p in self._unindexed if p < owner] + [owner]
+
+    def handle(self, request):
+        return self._handle(request) is not None
+
+    def _handle(self, request):
+        """处理请求，返回处理它的处理程序的位置"""
+        route = self.route(request)
+        for position in route:
+            if self.handlers[position].check_range(request):
+                return position
+        if route and route[-1] not in self._unindexed:
+            return self._walk(request, route[-1] + 1)
+        return None
+
+    def _walk(self, request, start):
+        # 区间声明与 check_range 不一致时，从这个位置继续线性遍历
+        for position in range(start, len(self.handlers)):
+            if self.handlers[position].check_range(request):
+                return position
+        return None
+
+    def handle_many(self, requests):
+        """批量路由一组请求
+
+        一次遍历将请求按处理程序分组，每个处理程序通过 check_range_many 一次收到
+        自己的整组请求。返回每个处理程序处理的请求数，以及没有被处理的请求。
+        """
+        groups = {}
+        single = []
+        remaining = []
+        for request in requests:
+            owner = self.owner(request)
+            if owner is None:
+                remaining.append(request)
+            elif self._unindexed and self._unindexed[0] < owner:
+                # 前面还有没有声明区间的处理程序，只能逐个处理
+                single.append(request)
+            else:
+                groups.setdefault(owner, []).append(request)
+
+        counts = dict.fromkeys(self.handlers, 0)
+        unhandled = []
+
+        def record(request, position):
+            if position is None:
+                unhandled.append(request)
+            else:
+                counts[self.handlers[position]] += 1
+
+        for position, group in groups.items():
+            rejected = self.handlers[position].check_range_many(group)
+            counts[self.handlers[position]] += len(group) - len(rejected)
+            for request in rejected:
+                record(request, self._walk(request, position + 1))
+        for request in single:
+            record(request, self._handle(request))
+
+        for position in self._unindexed:
+            handler = self.handlers[position]
+            rejected = handler.check_range_many(remaining)
+            counts[handler] += len(remaining) - len(rejected)
+            remaining = rejected
+        return counts, unhandled + remaining
+
+
+def _overlaps(a, b):
+    (start_a, end_a), (start_b, end_b) = a.interval, b.interval
+    return (
+        start_a < end_b
+        and start_b < end_a
+        or a.interval_closed and end_a == start_b
+        or b.interval_closed and end_b == start_a
+    )
+
+
+class InstrumentedChain:
+    """记录每个处理程序的调用次数、命中次数和 check_range 耗时的处理程序链
+
+    adaptive 为真时，每处理 reorder_every 个请求就重新排序一次：相邻的、区间互不重叠的
+    处理程序之间按命中次数从高到低排列，最常用的处理程序最先被尝试。区间重叠或者没有
+    声明区间的处理程序保持原来的相对位置，所以路由的结果不变。原来的链不会被修改。
+    """
+
+    def __init__(self, head, adaptive=False, reorder_every=1000):
+        self.order = list(head._handlers())
+        self.adaptive = adaptive
+        self.reorder_every = reorder_every
+        self._counters = {handler: [0, 0, 0.0] for handler in self.order}
+        self._requests = 0
+
+    def handle(self, request):
+        clock = time.perf_counter
+        for handler in self.order:
+            counter = self._counters[handler]
+            started = clock()
+            res = handler.check_range(request)
+            counter[2] += clock() - started
+            counter[0] += 1
+            if res:
+                counter[1] += 1
+                break
+        self._requests += 1
+        if self.adaptive and self._requests % self.reorder_every == 0:
+            self.reorder()
+        return bool(res)
+
+    def stats(self):
+        """按当前顺序返回每个处理程序的统计快照"""
+        return [
+            {
+                "handler": type(handler).__name__,
+                "calls": self._counters[handler][0],
+                "hits": self._counters[handler][1],
+                "seconds": self._counters[handler][2],
+            }
+            for handler in self.order
+        ]
+
+    def hops(self):
+        """每个请求平均调用 check_range 的次数"""
+        calls = sum(counter[0] for counter in self._counters.values())
+        return calls / self._requests if self._requests else 0.0
+
+    def reorder(self):
+        order, run = [], []
+        for handler in self.order + [None]:
+            if (
+                handler is not None
+                and handler.interval is not None
+                and not any(_overlaps(handler, other) for other in run)
+            ):
+                run.append(handler)
+                continue
+            order.extend(
+                sorted(run, key=lambda h: self._counters[h][1], reverse=True)
+            )
+            run = []
+            if handler is None:
+                break
+            if handler.interval is None:
+                order.append(handler)
+            else:
+                run.append(handler)
+        self.order = order
+
+
+def benchmark_adaptive(requests=200000, seed=0):
+    """在偏斜的负载上比较固定顺序和自适应顺序的平均跳数和耗时
+
+    90% 的请求由链上最后一个区间处理程序处理，9% 由第二个，1% 由第一个。
+    处理程序中的 print 被替换成什么都不做的函数。
+    """
+    rng = random.Random(seed)
+    workload = [
+        rng.randrange(20, 30)
+        if x < 0.9
+        else rng.randrange(10, 20)
+        if x < 0.99
+        else rng.randrange(0, 10)
+        for x in (rng.random() for _ in range(requests))
+    ]
+    results = []
+    globals()["print"] = lambda *args, **kwargs: None
+    try:
+        for adaptive in (False, True):
+            head = ConcreteHandler0(
+                ConcreteHandler1(ConcreteHandler2(FallbackHandler()))
+            )
+            chain = InstrumentedChain(head, adaptive=adaptive)
+            started = time.perf_counter()
+            for request in workload:
+                chain.handle(request)
+            elapsed = time.perf_counter() - started
+            results.append((adaptive, chain.hops(), elapsed))
+    finally:
+        del globals()["print"]
+    for adaptive, hops, elapsed in results:
+        print(
+            "{0}: {1:.2f} hops per request, {2:.3f}s for {3} requests".format(
+                "adaptive" if adaptive else "fixed", hops, elapsed, requests
+            )
+        )
+
+
+class _QuietHandler(Handler):
+    """不输出的处理程序，用来测量遍历链本身的开销"""
+
+    def __init__(self, value, successor=None):
+        super().__init__(successor)
+        self.value = value
+
+    def check_range(self, request):
+        return request == self.value
+
+
+def _handle_recursively(handler, request):
+    # 原来递归调用 successor.handle 的实现，用来比较
+    if not handler.check_range(request) and handler.successor:
+        _handle_recursively(handler.successor, request)
+
+
+def benchmark_depth(
+    depths=(10, 1000, 100000), number=20, recursion_limit=5000
+):
+    """比较不同长度的链上递归遍历和沿展开的链循环遍历的耗时
+
+    请求由链上最后一个处理程序处理，每次都遍历整条链。递归遍历时递归深度限制临时提高到
+    recursion_limit，更长的链仍然会抛出 RecursionError。
+    """
+    limit = sys.getrecursionlimit()
+    for depth in depths:
+        head = None
+        for value in range(depth):
+            head = _QuietHandler(value, head)
+        started = time.perf_counter()
+        head.handle(0)
+        first = time.perf_counter() - started
+        loop = timeit.timeit(lambda: head.handle(0), number=number) / number
+        sys.setrecursionlimit(max(limit, recursion_limit))
+        try:
+            recursive = timeit.timeit(
+                lambda: _handle_recursively(head, 0), number=number
+            )
+        except RecursionError:
+            recursive = "RecursionError"
+        else:
+            recursive = "{0:.6f}s".format(recursive / number)
+        finally:
+            sys.setrecursionlimit(limit)
+        print(
+            "depth {0}: loop {1:.6f}s (first call {2:.6f}s), "
+            "recursive {3}".format(depth, loop, first, recursive)
+        )
+
+
 def main():
     """
     >>> h0 = ConcreteHandler0()
@@ -109,13 +539,89 @@ def main():
     end of chain, no handler 35
     request 27 handled in handler 2
     request 20 handled in handler 2
+
+    >>> chain = CompiledChain(h0)
+    >>> for request in requests:
+    ...     _ = chain.handle(request)
+    request 2 handled in handler 0
+    request 5 handled in handler 0
+    request 14 handled in heandler 1
+    request 22 handled in handler 2
+    request 18 handled in heandler 1
+    request 3 handled in handler 0
+    end of chain, no handler 35
+    request 27 handled in handler 2
+    request 20 handled in handler 2
+
+    >>> counts, unhandled = chain.handle_many(requests)
+    request 2 handled in handler 0
+    request 5 handled in handler 0
+    request 3 handled in handler 0
+    request 14 handled in heandler 1
+    request 18 handled in heandler 1
+    request 22 handled in handler 2
+    request 27 handled in handler 2
+    request 20 handled in handler 2
+    end of chain, no handler 35
+    >>> [counts[h] for h in (h0, h1, h2, h3)], unhandled
+    ([3, 2, 3, 0], [35])
+
+    >>> h2 = AsyncConcreteHandler2(successor=h0)
+    >>> h1.successor = h3
+    >>> async def handle_all():
+    ...     await h2.prefetch_chain()
+    ...     for request in requests:
+    ...         await h2.handle(request)
+    >>> asyncio.run(handle_all())
+    request 2 handled in handler 0
+    request 5 handled in handler 0
+    request 14 handled in heandler 1
+    request 22 handled in handler 2
+    request 18 handled in heandler 1
+    request 3 handled in handler 0
+    end of chain, no handler 35
+    request 27 handled in handler 2
+    request 20 handled in handler 2
+
+    >>> h1.successor = h2 = ConcreteHandler2()
+    >>> h2.successor = h3
+    >>> chain = InstrumentedChain(h0, adaptive=True, reorder_every=4)
+    >>> for request in [25, 26, 27, 28]:
+    ...     _ = chain.handle(request)
+    request 25 handled in handler 2
+    request 26 handled in handler 2
+    request 27 handled in handler 2
+    request 28 handled in handler 2
+    >>> for stats in chain.stats():
+    ...     print(stats["handler"], stats["calls"], stats["hits"])
+    ConcreteHandler0 4 0
+    ConcreteHandler2 4 4
+    ConcreteHandler1 4 0
+    FallbackHandler 0 0
+    >>> chain.hops()
+    3.0
+
+    >>> deep = FallbackHandler()
+    >>> for _ in range(5000):
+    ...     deep = ConcreteHandler1(successor=deep)
+    >>> deep.handle(15)
+    request 15 handled in heandler 1
+    >>> deep.handle(35)
+    end of chain, no handler 35
    """
 
 
 if __name__ == "__main__":
-    import doctest
+    import sys
+
+    # python chain_of_responsibility.py --benchmark 运行性能测试
+    if "--benchmark" in sys.argv:
+        benchmark_adaptive()
+        benchmark_depth()
+    else:
+        import doctest
 
-    doctest.testmod(verbose=True, optionflags=doctest.ELLIPSIS)
+        doctest.testmod(verbose=True, optionflags=doctest.ELLIPSIS)
 
 ##### OUTPUT #####
 # request 2 handled in handler 0
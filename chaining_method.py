@@ -1,5 +1,6 @@
 """不断回调下一个对象的方法
 """
+import sys
 
 
 class Person:
@@ -13,15 +14,69 @@ class Person:
 
 
 class Action:
+    # 调用后结束链条的方法
+    terminal = ("stop",)
+
     def __init__(self, name):
         self.name = name
 
+    def format_step(self, method, args):
+        """链中一次调用输出的文本，立即执行和延迟执行都使用它"""
+        if method == "stop":
+            return "then stop"
+        return " ".join(str(arg) for arg in args)
+
     def amount(self, val):
-        print(val, end=" ")
+        print(self.format_step("amount", (val,)), end=" ")
         return self
 
     def stop(self):
-        print("then stop")
+        print(self.format_step("stop", ()))
+
+
+class Plan:
+    """延迟执行的计划
+
+    对 Action 方法的链式调用被记录为 (方法名, 参数) 步骤，直到调用 action.terminal 中的方法
+    才执行，所有输出一次写入。每个步骤的文本由 action.format_step 生成，所以和立即执行的
+    输出一致。返回的计划可以在多个 Person 上重复执行，而不需要重新遍历调用链。
+    """
+
+    def __init__(self, action, steps=(), person=None):
+        self.action = action
+        self.steps = steps
+        self._person = person
+
+    def __getattr__(self, method):
+        if method.startswith("_") or not callable(
+            getattr(self.action, method, None)
+        ):
+            raise AttributeError(method)
+
+        def record(*args):
+            steps = self.steps + ((method, args),)
+            if method not in self.action.terminal:
+                return Plan(self.action, steps, self._person)
+            plan = Plan(self.action, steps)
+            if self._person is not None:
+                plan.run(self._person)
+            return plan
+
+        return record
+
+    def run(self, *persons, file=None):
+        tail = " ".join(
+            [self.action.name]
+            + [self.action.format_step(*step) for step in self.steps]
+        )
+        (file or sys.stdout).write(
+            "".join("{} {}\n".format(person.name, tail) for person in persons)
+        )
+
+
+class DeferredPerson(Person):
+    def do_action(self):
+        return Plan(self.action, person=self)
 
 
 def main():
@@ -30,6 +85,26 @@ def main():
     >>> person = Person('Jack', move)
     >>> person.do_action().amount('5m').stop()
     Jack move 5m then stop
+
+    >>> person = DeferredPerson('Jack', move)
+    >>> plan = person.do_action().amount('5m').stop()
+    Jack move 5m then stop
+    >>> plan.run(Person('Rose', move), Person('Tom', move))
+    Rose move 5m then stop
+    Tom move 5m then stop
+    >>> plan.steps
+    (('amount', ('5m',)), ('stop', ()))
+
+    >>> class Run(Action):
+    ...     def format_step(self, method, args):
+    ...         if method == "amount":
+    ...             return "{} fast".format(*args)
+    ...         return super().format_step(method, args)
+    >>> run = Run('run')
+    >>> Person('Jack', run).do_action().amount('5m').stop()
+    Jack run 5m fast then stop
+    >>> plan = DeferredPerson('Jack', run).do_action().amount('5m').stop()
+    Jack run 5m fast then stop
     """
 
 
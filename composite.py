@@ -20,34 +20,292 @@ https://infinitescript.com/2014/10/the-23-gang-of-three-design-patterns/
 
 总而言之，组合模式描述的是一组对象可以像单个实例一样来对待。
 """
+import array
+import contextlib
+import io
+import sys
+import time
+import tracemalloc
 
 
 class Graphic:
     def render(self):
         raise NotImplementedError("You should implement this.")
 
+    def rendered(self):
+        """返回渲染的结果，默认捕获 render() 的输出"""
+        buffer = io.StringIO()
+        with contextlib.redirect_stdout(buffer):
+            self.render()
+        return buffer.getvalue()
+
+    def mark_dirty(self):
+        """图形改变之后通知包含它的组合对象重新渲染"""
+        for parent in self.__dict__.get("_parents", ()):
+            parent.mark_dirty()
+
 
 class CompositeGraphic(Graphic):
+    """组合对象缓存渲染的结果，只有子树改变之后才重新渲染"""
+
     def __init__(self):
         self.graphics = []
+        self._cache = None
 
     def render(self):
-        for graphic in self.graphics:
-            graphic.render()
+        print(self.rendered(), end="")
+
+    def rendered(self):
+        # 干净的子树直接使用缓存的结果
+        if self._cache is None:
+            self._cache = "".join(
+                graphic.rendered() for graphic in self.graphics
+            )
+        return self._cache
+
+    def mark_dirty(self):
+        # 祖先节点在子节点之前已经被标记过了，不需要再向上传播
+        if self._cache is not None:
+            self._cache = None
+            super().mark_dirty()
 
     def add(self, graphic):
         self.graphics.append(graphic)
+        graphic.__dict__.setdefault("_parents", []).append(self)
+        self.mark_dirty()
 
     def remove(self, graphic):
         self.graphics.remove(graphic)
+        graphic._parents.remove(self)
+        self.mark_dirty()
 
 
 class Ellipse(Graphic):
     def __init__(self, name):
         self.name = name
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+        self.mark_dirty()
+
     def render(self):
-        print("Ellipse: {}".format(self.name))
+        print(self.rendered(), end="")
+
+    def rendered(self):
+        return "Ellipse: {}\n".format(self.name)
+
+
+class GraphicTree:
+    """使用数组存储的紧凑的图形树
+
+    每个节点用一个整数句柄表示，父节点和兄弟节点的关系存在数组中，子节点组成双向链表，
+    所以通过句柄删除子节点是 O(1) 的。渲染不使用递归，沿着数组遍历整棵树并把结果
+    写入一个缓冲区，所以树的深度不受递归深度的限制。句柄 0 是根节点。
+    """
+
+    ROOT = 0
+    _NONE = -1
+
+    def __init__(self):
+        self.parent = array.array("q")
+        self.first_child = array.array("q")
+        self.last_child = array.array("q")
+        self.next_sibling = array.array("q")
+        self.prev_sibling = array.array("q")
+        # 组合节点的名字是 None
+        self.names = []
+        self._new_node(self._NONE, None)
+
+    def _new_node(self, parent, name):
+        handle = len(self.names)
+        for column in (
+            self.first_child,
+            self.last_child,
+            self.next_sibling,
+            self.prev_sibling,
+        ):
+            column.append(self._NONE)
+        self.parent.append(parent)
+        self.names.append(name)
+        if parent != self._NONE:
+            last = self.last_child[parent]
+            if last == self._NONE:
+                self.first_child[parent] = handle
+            else:
+                self.next_sibling[last] = handle
+                self.prev_sibling[handle] = last
+            self.last_child[parent] = handle
+        return handle
+
+    def add_composite(self, parent=ROOT):
+        return self._new_node(parent, None)
+
+    def add_ellipse(self, name, parent=ROOT):
+        return self._new_node(parent, name)
+
+    def remove(self, handle):
+        """将节点和它的子树从父节点上摘下来"""
+        parent = self.parent[handle]
+        prev, next_ = self.prev_sibling[handle], self.next_sibling[handle]
+        if prev == self._NONE:
+            self.first_child[parent] = next_
+        else:
+            self.next_sibling[prev] = next_
+        if next_ == self._NONE:
+            self.last_child[parent] = prev
+        else:
+            self.prev_sibling[next_] = prev
+        self.parent[handle] = self.prev_sibling[handle] = self._NONE
+        self.next_sibling[handle] = self._NONE
+
+    def render(self, handle=ROOT, file=None):
+        """先序遍历子树，所有的输出一次写入"""
+        names, first_child = self.names, self.first_child
+        next_sibling, parent = self.next_sibling, self.parent
+        lines = []
+        node = handle
+        while True:
+            name = names[node]
+            if name is not None:
+                lines.append("Ellipse: {}\n".format(name))
+            child = first_child[node]
+            if child != self._NONE:
+                node = child
+                continue
+            # 没有子节点，向上找到下一个兄弟节点
+            while node != handle and next_sibling[node] == self._NONE:
+                node = parent[node]
+            if node == handle:
+                break
+            node = next_sibling[node]
+        (file or sys.stdout).write("".join(lines))
+
+    @classmethod
+    def from_graphic(cls, graphic):
+        """将 CompositeGraphic 和 Ellipse 组成的树转换成 GraphicTree"""
+        tree = cls()
+        stack = [(graphic, cls.ROOT)]
+        while stack:
+            node, handle = stack.pop()
+            if isinstance(node, CompositeGraphic):
+                # 先加入所有的子节点，保持它们的顺序
+                for child in node.graphics:
+                    if isinstance(child, CompositeGraphic):
+                        stack.append((child, tree.add_composite(handle)))
+                    else:
+                        tree.add_ellipse(child.name, handle)
+            else:
+                tree.add_ellipse(node.name, handle)
+        return tree
+
+
+def _measure(function):
+    """返回 function 的结果、耗时和它新分配的内存"""
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        result = function()
+        elapsed = time.perf_counter() - started
+        memory, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, memory
+
+
+def benchmark(leaves=200000, width=100, depth=20000, removals=1000):
+    """比较 CompositeGraphic 和 GraphicTree 的内存、建立、渲染和删除的开销
+
+    宽的树有 leaves 个叶子，每个组合节点下有 width 个椭圆；深的树是 depth 层嵌套的
+    组合节点。对象树的内存开销较大，所以默认的叶子数比较小，可以按需要调大。
+    """
+
+    def build_graphic():
+        root = CompositeGraphic()
+        for start in range(0, leaves, width):
+            group = CompositeGraphic()
+            for i in range(start, min(start + width, leaves)):
+                group.add(Ellipse(str(i)))
+            root.add(group)
+        return root
+
+    def build_tree():
+        tree = GraphicTree()
+        for start in range(0, leaves, width):
+            group = tree.add_composite()
+            for i in range(start, min(start + width, leaves)):
+                tree.add_ellipse(str(i), group)
+        return tree
+
+    graphic, graphic_build, graphic_memory = _measure(build_graphic)
+    tree, tree_build, tree_memory = _measure(build_tree)
+    started = time.perf_counter()
+    graphic.rendered()
+    graphic_render = time.perf_counter() - started
+    started = time.perf_counter()
+    tree.render(file=io.StringIO())
+    tree_render = time.perf_counter() - started
+    print(
+        "{0} leaves: CompositeGraphic {1:.1f} MB, build {2:.3f}s, "
+        "render {3:.3f}s".format(
+            leaves, graphic_memory / 2**20, graphic_build, graphic_render
+        )
+    )
+    print(
+        "{0} leaves: GraphicTree {1:.1f} MB, build {2:.3f}s, "
+        "render {3:.3f}s".format(
+            leaves, tree_memory / 2**20, tree_build, tree_render
+        )
+    )
+
+    # 从一个很宽的组合节点中删除子节点
+    parent = CompositeGraphic()
+    children = [Ellipse(str(i)) for i in range(leaves)]
+    for child in children:
+        parent.add(child)
+    started = time.perf_counter()
+    for child in children[-removals:]:
+        parent.remove(child)
+    graphic_remove = time.perf_counter() - started
+    wide = GraphicTree()
+    handles = [wide.add_ellipse(str(i)) for i in range(leaves)]
+    started = time.perf_counter()
+    for handle in handles[-removals:]:
+        wide.remove(handle)
+    tree_remove = time.perf_counter() - started
+    print(
+        "remove {0} of {1} children: CompositeGraphic {2:.3f}s, "
+        "GraphicTree {3:.3f}s".format(
+            removals, leaves, graphic_remove, tree_remove
+        )
+    )
+
+    # 很深的树
+    graphic = node = CompositeGraphic()
+    tree, handle = GraphicTree(), GraphicTree.ROOT
+    for _ in range(depth):
+        child = CompositeGraphic()
+        node.add(child)
+        node = child
+        handle = tree.add_composite(handle)
+    node.add(Ellipse("deep"))
+    tree.add_ellipse("deep", handle)
+    try:
+        graphic.rendered()
+        graphic_deep = "ok"
+    except RecursionError:
+        graphic_deep = "RecursionError"
+    started = time.perf_counter()
+    tree.render(file=io.StringIO())
+    print(
+        "depth {0}: CompositeGraphic {1}, GraphicTree {2:.3f}s".format(
+            depth, graphic_deep, time.perf_counter() - started
+        )
+    )
 
 
 if __name__ == "__main__":
@@ -71,9 +329,25 @@ if __name__ == "__main__":
 
     graphic.render()  # 渲染组合对象
 
+    ellipse4.name = "4'"  # 只有 graphic2 和 graphic 需要重新渲染
+    graphic.render()
+
+    tree = GraphicTree.from_graphic(graphic)  # 转换成数组存储的树
+    tree.remove(1)  # 通过句柄删除 graphic1
+    tree.render()
+
+    # python composite.py --benchmark 比较内存和吞吐量
+    if "--benchmark" in sys.argv:
+        benchmark()
+
 
 ########## OUTPUT #########
 # Ellipse: 1
 # Ellipse: 2
 # Ellipse: 3
 # Ellipse: 4
+# Ellipse: 1
+# Ellipse: 2
+# Ellipse: 3
+# Ellipse: 4'
+# Ellipse: 4'